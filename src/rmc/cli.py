@@ -1,9 +1,7 @@
 """CLI for converting rm files."""
 
-import os
 import sys
 import io
-import json
 from pathlib import Path
 from contextlib import contextmanager
 from rmc.exporters import json as json_exporter
@@ -53,7 +51,7 @@ def cli(verbose, from_, to, output, input):
         to = guess_format(output)
 
     if from_ == "rm":
-        with open_output(to, output) as fout:
+        with open_output(output) as fout:
             for fn in input:
                 convert_rm(Path(fn), to, fout)
             else:
@@ -63,51 +61,63 @@ def cli(verbose, from_, to, output, input):
         raise click.UsageError("source format %s not implemented yet" % from_)
 
 
+# Large JSON dumps are written in many small pieces; buffer them generously
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+
 @contextmanager
-def open_output(to, output):
-    to_binary = to in ("pdf", "rm")
+def open_output(output):
+    # All formats are written as bytes; the JSON exporters produce UTF-8 directly
     if output is None:
         # Write to stdout
-        if to_binary:
-            with os.fdopen(sys.stdout.fileno(), "wb", closefd=False) as f:
-                yield f
-        else:
-            yield sys.stdout
+        sys.stdout.flush()
+        f = io.BufferedWriter(sys.stdout.buffer, buffer_size=OUTPUT_BUFFER_SIZE)
+        try:
+            yield f
+        finally:
+            # Leave sys.stdout itself open
+            f.flush()
+            f.detach()
     else:
-        with open(output, "w" + ("b" if to_binary else "t")) as f:
+        with open(output, "wb", buffering=OUTPUT_BUFFER_SIZE) as f:
             yield f
 
 
+# Format implied by each known file suffix
+_SUFFIX_FORMATS = {
+    ".rm": "rm",
+    ".svg": "svg",
+    ".pdf": "pdf",
+    ".md": "markdown",
+    ".markdown": "markdown",
+}
+
+
 def guess_format(p: Path):
-    # XXX could be neater
-    if p.suffix == ".rm":
-        return "rm"
-    if p.suffix == ".svg":
-        return "svg"
-    elif p.suffix == ".pdf":
-        return "pdf"
-    elif p.suffix == ".md" or p.suffix == ".markdown":
-        return "markdown"
-    else:
-        return "blocks"
+    return _SUFFIX_FORMATS.get(p.suffix, "blocks")
 
 
 from rmscene import scene_items as si
 def tree_structure(item):
     if isinstance(item, si.Group):
+        structure = tree_structure
+        anchor_id = item.anchor_id
+        anchor_type = item.anchor_type
+        anchor_threshold = item.anchor_threshold
+        anchor_origin_x = item.anchor_origin_x
         return (
             item.node_id,
             (
                 item.label.value,
                 item.visible.value,
                 (
-                    item.anchor_id.value if item.anchor_id else None,
-                    item.anchor_type.value if item.anchor_type else None,
-                    item.anchor_threshold.value if item.anchor_threshold else None,
-                    item.anchor_origin_x.value if item.anchor_origin_x else None,
+                    anchor_id.value if anchor_id is not None else None,
+                    anchor_type.value if anchor_type is not None else None,
+                    anchor_threshold.value if anchor_threshold is not None else None,
+                    anchor_origin_x.value if anchor_origin_x is not None else None,
                 )
             ),
-            [tree_structure(child) for child in item.children.values() if child],
+            [structure(child) for child in item.children.values() if child],
         )
     else:
         return item
@@ -132,66 +142,42 @@ def convert_rm(filename: Path, to, fout):
         elif to == "json":
             tree = read_tree(f)
             json_exporter.tree_to_json(tree, fout)
-        elif to == "tree":
-            # Experimental dumping of tree structure
-            json_tree(f, fout, data=True)
-        elif to == "tree-data":
+        elif to in ("tree", "tree-data"):
             # Experimental dumping of tree structure
-            json_tree(f, fout, data=False)
+            json_tree(f, fout)
         else:
             raise click.UsageError("Unknown format %s" % to)
 
 
 def json_blocks(f, fout, data=True) -> None:
-    depth = None if data else 1
-    result = read_blocks(f)
-    print("[", file=fout)
-    for el, notlast in lookahead(result):
-        json_string = json.dumps(el.__dict__, default=lambda o: getattr(o, '__dict__', None), indent=4)
-        print(json_string, file=fout)
-        if notlast:
-            print(",", file=fout)
-    print("]", file=fout)
-
-
-def json_tree(f, fout, data=True) -> None:
+    # blocks are written as they are read, separated by commas
+    fout.write(b"[")
+    sep = b"\n"
+    for el in read_blocks(f):
+        values = el.__dict__
+        if not data:
+            # Only the top level of each block, like pprint with depth=1
+            values = {k: v if v is None or isinstance(v, (str, int, float)) else "..."
+                      for k, v in values.items()}
+        fout.write(sep)
+        fout.write(json_exporter.dumps(values))
+        sep = b",\n"
+    fout.write(b"\n]\n")
+
+
+def json_tree(f, fout) -> None:
     tree = read_tree(f)
 
-    depth = None if data else 1
     tree_root = tree_structure(tree.root)
     tree_root_text = tree_structure(tree.root_text)
 
-    tree_root_json = json.dumps(tree_root, default=lambda o: getattr(o, '__dict__', None), indent=4)
-    print("[", file=fout)
-    print(tree_root_json, file=fout)
-    print(",", file=fout)
-    tree_root_text_json = json.dumps(tree_root, default=lambda o: getattr(o, '__dict__', None), indent=4)
-    print(tree_root_text_json, file=fout)
-    print("]", file=fout)
-
+    fout.write(json_exporter.dumps([tree_root, tree_root_text]))
+    fout.write(b"\n")
 
 
 def convert_text(text, fout):
     write_blocks(fout, simple_text_document(text))
 
-def lookahead(iterable):
-    """Pass through all values from the given iterable, augmented by the
-    information if there are more values to come after the current one
-    (True), or if it is the last value (False).
-    """
-    # Get an iterator and pull the first value.
-    it = iter(iterable)
-    try:
-        last = next(it)
-    except StopIteration:
-        return
-    # Run the iterator to exhaustion (starting from the second value).
-    for val in it:
-        # Report the *previous* value (more to come).
-        yield last, True
-        last = val
-    # Report the last value.
-    yield last, False
 
 if __name__ == "__main__":
     cli()
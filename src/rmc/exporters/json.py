@@ -4,12 +4,22 @@ Code originally from https://github.com/lschwetlick/maxio through
 https://github.com/chemag/maxio .
 """
 
+import collections
+import itertools
 import logging
 import string
 import json
 import typing as tp
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+else:
+    # Dataclasses are passed through to _default, like with the json module
+    _ORJSON_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATACLASS
+
 from rmscene import CrdtId, SceneTree, read_tree
 from rmscene import scene_items as si
 from rmscene.text import TextDocument
@@ -29,6 +39,50 @@ PAGE_HEIGHT_PT = SCREEN_HEIGHT * SCALE
 X_SHIFT = PAGE_WIDTH_PT // 2
 
 
+def _default(o):
+    """Fallback for objects the JSON encoder does not know how to serialize."""
+    d = getattr(o, '__dict__', None)
+    if not d:
+        return str(o)
+    # Dicts inside scene items (e.g. CrdtSequence) are keyed by CrdtId, which
+    # is not a valid JSON key
+    return {k: {str(kk): vv for kk, vv in v.items()} if isinstance(v, dict) else v
+            for k, v in d.items()}
+
+
+def dumps(obj) -> bytes:
+    """Serialize `obj` to indented, UTF-8 encoded JSON.
+
+    Uses orjson when it is installed, falling back to the standard library
+    encoder otherwise. Both use two-space indentation and give equivalent
+    JSON, though not byte-identical: floats may be formatted differently
+    (e.g. orjson writes 1e-6 where the json module writes 1e-06).
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+    return json.dumps(obj, default=_default, indent=2, ensure_ascii=False).encode()
+
+
+def dump_streamed(obj: dict, key: str, items: tp.Iterable, output) -> None:
+    """Write `obj` to the binary file `output` as JSON, with an extra `key` holding `items`.
+
+    The elements of `items` are encoded and written one at a time as the
+    iterable is consumed, so the complete list never has to be held in memory.
+    The layout is the same as `dumps(obj | {key: list(items)})`.
+    """
+    # Reopen the encoded object by dropping its closing "\n}", which is only
+    # there when it has at least one key (an empty one is encoded as "{}")
+    assert obj, "dump_streamed needs a non-empty object"
+    output.write(dumps(obj)[:-2])
+    output.write(b",\n  %s: [" % dumps(key))
+    sep = b"\n    "
+    for item in items:
+        output.write(sep)
+        output.write(dumps(item).replace(b"\n", b"\n    "))
+        sep = b",\n    "
+    output.write(b"]\n}" if sep == b"\n    " else b"\n  ]\n}")
+
+
 def scale(screen_unit: float) -> float:
     return screen_unit * SCALE
 
@@ -57,13 +111,16 @@ LINE_HEIGHTS = {
     # line, but there is still something a bit odd going on here.
 }
 
+# LINE_HEIGHTS falling back to the plain line height for any other style
+_LINE_HEIGHTS = collections.defaultdict(lambda: 70, LINE_HEIGHTS)
+
 SVG_HEADER = string.Template("""<?xml version="1.0" encoding="UTF-8"?>
 <svg xmlns="http://www.w3.org/2000/svg" height="$height" width="$width" viewBox="$viewbox">""")
 
 
 def rm_to_json(rm_path, svg_path):
     """Convert `rm_path` to SVG at `svg_path`."""
-    with open(rm_path, "rb") as infile, open(svg_path, "wt") as outfile:
+    with open(rm_path, "rb") as infile, open(svg_path, "wb") as outfile:
         tree = read_tree(infile)
         tree_to_json(tree, outfile)
 
@@ -76,12 +133,15 @@ def read_template_svg(template_path: Path) -> str:
 def tree_to_json(tree: SceneTree, output, include_template: Path | None = None):
     """Convert Blocks to SVG."""
 
+    # the text document is needed for both the anchors and the text itself
+    doc = TextDocument.from_scene_item(tree.root_text) if tree.root_text is not None else None
+
     # find the anchor pos for further use
-    anchor_pos = build_anchor_pos(tree.root_text)
+    anchor_pos = build_anchor_pos(tree.root_text, doc)
     _logger.debug("anchor_pos: %s", anchor_pos)
 
-    # find the extremum along x and y
-    x_min, x_max, y_min, y_max = get_bounding_box(tree.root, anchor_pos)
+    # find the extremum along x and y, and the strokes to draw, in a single walk
+    (x_min, x_max, y_min, y_max), strokes = walk_tree(tree.root, anchor_pos)
     width_pt = xx(x_max - x_min + 1)
     height_pt = yy(y_max - y_min + 1)
     _logger.debug("x_min, x_max, y_min, y_max: %.1f, %.1f, %.1f, %.1f ; scalded %.1f, %.1f, %.1f, %.1f",
@@ -98,9 +158,7 @@ def tree_to_json(tree: SceneTree, output, include_template: Path | None = None):
 
     text = []
     if tree.root_text is not None:
-        text = draw_text(tree.root_text, output)
-
-    points = draw_group(tree.root, output, anchor_pos, True)
+        text = draw_text(tree.root_text, output, doc)
 
     r = {
         "page" : page,
@@ -111,17 +169,17 @@ def tree_to_json(tree: SceneTree, output, include_template: Path | None = None):
             "y": y_min,
         },
         "text" : text,
-        "points" : points
     }
-    json_string = json.dumps(r, indent=4)
-    output.write(json_string)
+    # points are streamed to the output as the tree is walked
+    dump_streamed(r, "points", iter_stroke_points(strokes, output), output)
 
 
-def build_anchor_pos(text: tp.Optional[si.Text]) -> tp.Dict[CrdtId, int]:
+def build_anchor_pos(text: tp.Optional[si.Text], doc: tp.Optional[TextDocument] = None) -> tp.Dict[CrdtId, int]:
     """
     Find the anchor pos
 
     :param text: the root text of the remarkable file
+    :param doc: the TextDocument of `text`, if it has already been built
     """
     # Special anchors adjusted based on pen_size_test.strokes.rm
     anchor_pos = {
@@ -131,14 +189,16 @@ def build_anchor_pos(text: tp.Optional[si.Text]) -> tp.Dict[CrdtId, int]:
 
     if text is not None:
         # Save anchor from text
-        doc = TextDocument.from_scene_item(text)
+        if doc is None:
+            doc = TextDocument.from_scene_item(text)
         ypos = text.pos_y + TEXT_TOP_Y
-        for i, p in enumerate(doc.contents):
+        line_heights = _LINE_HEIGHTS
+        for p in doc.contents:
             anchor_pos[p.start_id] = ypos
             for subp in p.contents:
                 for k in subp.i:
                     anchor_pos[k] = ypos  # TODO check these anchor are used
-            ypos += LINE_HEIGHTS.get(p.style.value, 70)
+            ypos += line_heights[p.style.value]
 
     return anchor_pos
 
@@ -161,6 +221,94 @@ def get_anchor(item: si.Group, anchor_pos):
     return anchor_x, anchor_y
 
 
+# Kinds of record produced by flatten_tree
+GROUP_ENTER = 0
+GROUP_EXIT = 1
+LINE = 2
+
+
+def flatten_tree(item: si.Group, anchor_pos: tp.Dict[CrdtId, int]) \
+        -> tp.List[tp.Tuple[int, si.SceneItem, float, float, float, float]]:
+    """
+    Flatten the group `item` into a list of records in pre-order.
+
+    Every group, including `item` itself, is bracketed by a GROUP_ENTER and a
+    GROUP_EXIT record, with LINE records for the strokes it contains in between.
+    Each record is (kind, item, offset_x, offset_y, anchor_x, anchor_y), where
+    the anchor is that of the group, or of the line's own group, and the offset
+    accumulates the anchors of the nested groups below `item` (the anchor of
+    `item` itself is not part of it).
+    """
+    anchor_x, anchor_y = get_anchor(item, anchor_pos)
+    nodes = [(GROUP_ENTER, item, 0.0, 0.0, anchor_x, anchor_y)]
+    append = nodes.append
+    # explicit stack of (group, iterator over its remaining children, offset, anchor)
+    stack = [(item, iter(item.children.values()), 0.0, 0.0, anchor_x, anchor_y)]
+    while stack:
+        group, children, offset_x, offset_y, anchor_x, anchor_y = stack[-1]
+        for child in children:
+            if isinstance(child, si.Group):
+                child_anchor_x, child_anchor_y = get_anchor(child, anchor_pos)
+                child_offset_x = offset_x + child_anchor_x
+                child_offset_y = offset_y + child_anchor_y
+                append((GROUP_ENTER, child, child_offset_x, child_offset_y, child_anchor_x, child_anchor_y))
+                stack.append((child, iter(child.children.values()), child_offset_x, child_offset_y,
+                              child_anchor_x, child_anchor_y))
+                break
+            elif isinstance(child, si.Line):
+                append((LINE, child, offset_x, offset_y, anchor_x, anchor_y))
+        else:
+            append((GROUP_EXIT, group, offset_x, offset_y, anchor_x, anchor_y))
+            stack.pop()
+    return nodes
+
+
+def collect_strokes(item: si.Group, anchor_pos: tp.Dict[CrdtId, int]) \
+        -> tp.List[tp.Tuple[si.Line, float, float]]:
+    """Collect the strokes of the group `item` as (line, anchor_x, anchor_y) tuples, with the anchor of the line's own group."""
+    return [(node, anchor_x, anchor_y)
+            for kind, node, _, _, anchor_x, anchor_y in flatten_tree(item, anchor_pos)
+            if kind == LINE]
+
+
+def walk_tree(item: si.Group,
+              anchor_pos: tp.Dict[CrdtId, int],
+              default: tp.Tuple[int, int, int, int] = (- SCREEN_WIDTH // 2, SCREEN_WIDTH // 2, 0, SCREEN_HEIGHT)) \
+        -> tp.Tuple[tp.Tuple[int, int, int, int], tp.List[tp.Tuple[si.Line, float, float]]]:
+    """
+    Walk the group `item` once, finding its bounding box and collecting its strokes.
+
+    :return: the bounding box (see `get_bounding_box`), and the strokes (see `collect_strokes`)
+    """
+    x_min, x_max, y_min, y_max = default
+
+    strokes = []
+    append = strokes.append
+
+    nodes = flatten_tree(item, anchor_pos)
+    # the origin of `item` itself is not part of the box
+    for kind, node, offset_x, offset_y, anchor_x, anchor_y in itertools.islice(nodes, 1, None):
+        if kind == GROUP_ENTER:
+            # the origin of a nested group is always part of the box
+            x_min = min(x_min, offset_x)
+            x_max = max(x_max, offset_x)
+            y_min = min(y_min, offset_y)
+            y_max = max(y_max, offset_y)
+        elif kind == LINE:
+            append((node, anchor_x, anchor_y))
+            points = node.points
+            if points:
+                # the box of the line itself, then shifted as a whole
+                xs = [p.x for p in points]
+                ys = [p.y for p in points]
+                x_min = min(x_min, min(xs) + offset_x)
+                x_max = max(x_max, max(xs) + offset_x)
+                y_min = min(y_min, min(ys) + offset_y)
+                y_max = max(y_max, max(ys) + offset_y)
+
+    return (x_min, x_max, y_min, y_max), strokes
+
+
 def get_bounding_box(item: si.Group,
                      anchor_pos: tp.Dict[CrdtId, int],
                      default: tp.Tuple[int, int, int, int] = (- SCREEN_WIDTH // 2, SCREEN_WIDTH // 2, 0, SCREEN_HEIGHT)) \
@@ -171,123 +319,117 @@ def get_bounding_box(item: si.Group,
 
     :return: x_min, x_max, y_min, y_max: the bounding box in screen units (need to be scalded using xx and yy functions)
     """
-    x_min, x_max, y_min, y_max = default
+    bounding_box, _ = walk_tree(item, anchor_pos, default)
+    return bounding_box
 
-    for child_id in item.children:
-        child = item.children[child_id]
-        if isinstance(child, si.Group):
-            anchor_x, anchor_y = get_anchor(child, anchor_pos)
-            x_min_t, x_max_t, y_min_t, y_max_t = get_bounding_box(child, anchor_pos, (0, 0, 0, 0))
-            x_min = min(x_min, x_min_t + anchor_x)
-            x_max = max(x_max, x_max_t + anchor_x)
-            y_min = min(y_min, y_min_t + anchor_y)
-            y_max = max(y_max, y_max_t + anchor_y)
-        elif isinstance(child, si.Line):
-            x_min = min([x_min] + [p.x for p in child.points])
-            x_max = max([x_max] + [p.x for p in child.points])
-            y_min = min([y_min] + [p.y for p in child.points])
-            y_max = max([y_max] + [p.y for p in child.points])
 
-    return x_min, x_max, y_min, y_max
+def iter_stroke_points(strokes: tp.Iterable[tp.Tuple[si.Line, float, float]], output) -> tp.Iterator[dict]:
+    """Yield the points of the (line, anchor_x, anchor_y) strokes from `collect_strokes`, offset by their anchor."""
+    for line, anchor_x, anchor_y in strokes:
+        yield from draw_stroke(line, output, anchor_x, anchor_y, True)
 
 
 def draw_group(item: si.Group, output, anchor_pos, flatten: bool = False):
-    anchor_x, anchor_y = get_anchor(item, anchor_pos)
-
-    items = []
-    groups = []
-
-    for child_id in item.children:
-        child = item.children[child_id]
-        if isinstance(child, si.Group):
-            if flatten:
-                items.extend(draw_group(child, output, anchor_pos, flatten))
-            else:
-                groups.append(draw_group(child, output, anchor_pos))
-        elif isinstance(child, si.Line):
-            if flatten:
-                items.extend(draw_stroke(child, output, anchor_x, anchor_y, flatten))
-            else:
-                items.append(draw_stroke(child, output, anchor_x, anchor_y, flatten))
     if flatten:
-        return items
-    else:
-        return {
-            "id": item.node_id.__repr__(),
-            "type": "group",
-            "items": items,
-            "groups": groups,
-            "anchor": {
-                "x": anchor_x,
-                "y": anchor_y,
-            },
-        }
+        return list(iter_stroke_points(collect_strokes(item, anchor_pos), output))
+
+    # dicts of the enclosing groups; each one is attached to its parent as
+    # soon as it is created, so the top one is complete once it is popped
+    stack = []
+    for kind, node, _, _, anchor_x, anchor_y in flatten_tree(item, anchor_pos):
+        if kind == GROUP_ENTER:
+            group = {
+                "id": node.node_id.__repr__(),
+                "type": "group",
+                "items": [],
+                "groups": [],
+                "anchor": {
+                    "x": anchor_x,
+                    "y": anchor_y,
+                },
+            }
+            if stack:
+                stack[-1]["groups"].append(group)
+            stack.append(group)
+        elif kind == GROUP_EXIT:
+            group = stack.pop()
+        else:
+            stack[-1]["items"].append(list(draw_stroke(node, output, anchor_x, anchor_y)))
+    return group
 
 
-def draw_stroke(item: si.Line, output, anchor_x = None, anchor_y = None, flatten: bool = False):
+def draw_stroke(item: si.Line, output, anchor_x = None, anchor_y = None, flatten: bool = False) -> tp.Iterator[dict]:
     # initiate the pen
     pen = Pen.create(item.tool.value, item.color.value, item.thickness_scale)
 
-    points = []
+    # Bind what the loop uses to locals, as it runs for every segment of every stroke
+    get_segment_color = pen.get_segment_color
+    get_segment_width = pen.get_segment_width
+    get_segment_opacity = pen.get_segment_opacity
+    factor = SCALE
+
+    last_segment_width = 0
+    # Only the first point of each segment is drawn, so step straight to those
+    for point in item.points[::pen.segment_length]:
+        x = point.x
+        y = point.y
+        speed = point.speed
+        direction = point.direction
+        width = point.width
+        pressure = point.pressure
 
-    last_segment_width = segment_width = 0
-    # Iterate through the point to form a polyline
-    for point_id, point in enumerate(item.points):
         # align the original position
-        xpos = point.x + anchor_x if flatten else point.x
-        ypos = point.y + anchor_y if flatten else point.y
-        
-        if point_id % pen.segment_length == 0:
-
-            segment_color = pen.get_segment_color(point.speed, point.direction, point.width, point.pressure,
-                                                  last_segment_width)
-            segment_width = pen.get_segment_width(point.speed, point.direction, point.width, point.pressure,
-                                                  last_segment_width)
-            segment_opacity = pen.get_segment_opacity(point.speed, point.direction, point.width, point.pressure,
-                                                      last_segment_width)
-                                                      
-            points.append({
-                "x": xx(xpos),
-                "y": yy(ypos),
-                "xorg": point.x,
-                "yorg": point.y,
-                "anchorx": anchor_x,
-                "anchory": anchor_y,
-                "color": segment_color,
-                "width": segment_width,
-                "opacity": segment_opacity,
-            })
-            
-        last_segment_width = segment_width
-
+        xpos = x + anchor_x if flatten else x
+        ypos = y + anchor_y if flatten else y
+
+        segment_color = get_segment_color(speed, direction, width, pressure, last_segment_width)
+        segment_width = get_segment_width(speed, direction, width, pressure, last_segment_width)
+        segment_opacity = get_segment_opacity(speed, direction, width, pressure, last_segment_width)
+
+        # xx and yy are a plain multiplication by SCALE, inlined here
+        yield {
+            "x": xpos * factor,
+            "y": ypos * factor,
+            "xorg": x,
+            "yorg": y,
+            "anchorx": anchor_x,
+            "anchory": anchor_y,
+            "color": segment_color,
+            "width": segment_width,
+            "opacity": segment_opacity,
+        }
 
-    # end stroke
-    return points
+        last_segment_width = segment_width
 
 
-def draw_text(text: si.Text, output):
+def draw_text(text: si.Text, output, doc: tp.Optional[TextDocument] = None):
 
     y_offset = TEXT_TOP_Y
 
-    doc = TextDocument.from_scene_item(text)
+    if doc is None:
+        doc = TextDocument.from_scene_item(text)
 
     lines = []
+    append = lines.append
+    line_heights = _LINE_HEIGHTS
+    xpos = text.pos_x
+    pos_y = text.pos_y
 
     for p in doc.contents:
-        y_offset += LINE_HEIGHTS.get(p.style.value, 70)
+        style = p.style.value
+        y_offset += line_heights[style]
 
-        xpos = text.pos_x
-        ypos = text.pos_y + y_offset
-        cls = p.style.value.name.lower()
-        if str(p):
+        ypos = pos_y + y_offset
+        cls = style.name.lower()
+        content = str(p)
+        if content:
             # TODO: this doesn't take into account the CrdtStr.properties (font-weight/font-style)
-            output.write(f'\t\t\t<text x="{xx(xpos)}" y="{yy(ypos)}" class="{cls}">{str(p).strip()}</text>\n')
-            lines.append({
+            append({
                 "x": xx(xpos),
                 "y": yy(ypos),
                 "xorg": xpos,
                 "yorg": ypos,
-                "text": str(p).strip(),
+                "text": content.strip(),
                 "class": cls,
             })
 